@@ -1,75 +1,103 @@
+from typing import Any
+
 import numpy as np
 import pandas as pd
-import plotly.express as px
+from plotly.colors import qualitative
 import plotly.graph_objects as go
 import streamlit as st
 import streamlit_antd_components as sac
 
-from garbanzo.app.utils import get_ledger, setup_sidebar
-from garbanzo.ledger import Ledger
+from garbanzo.app.utils import get_account_flows, get_income_expense_data, get_ledger, setup_sidebar
+from garbanzo.ledger import FilterOptions, Ledger, TimeGrain
 
 
 # TODO: configure this
 MAX_STACK_SEGMENTS = 6
+# maximum number of time periods to plot before switching to a coarser time grain
+MAX_PERIODS = 500
 
-D3_COLORS = px.colors.qualitative.D3
+D3_COLORS = qualitative.D3
+assert len(D3_COLORS) >= MAX_STACK_SEGMENTS + 1
+# colors for income, disposable income, expenses, savings
+SAVINGS_COLORS = [D3_COLORS[i] for i in [2, 0, 3, 4]]
 
 st.set_page_config(layout = 'wide')
 
 
-def render_percent(pct: float) -> tuple[str, str]:
-    if np.isnan(pct):
-        return ('', 'gray')
-    pct = round(pct)
-    pct_str = f'{pct}%'
-    if (pct > 0):
-        return (f'▲ {pct_str}', D3_COLORS[2])
-    if (pct < 0):
-        return (f'▼ {pct_str}', D3_COLORS[3])
-    return (pct_str, 'gray')
+def render_percents(pcts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Given an array of percentages, returns arrays of display labels and their colors.
+    Missing (or infinite) percentages are rendered as empty labels."""
+    valid = np.isfinite(pcts)
+    rounded = np.round(np.where(valid, pcts, 0.0)).astype(int)
+    up = valid & (rounded > 0)
+    down = valid & (rounded < 0)
+    arrows = np.select([up, down], ['▲ ', '▼ '], '')
+    text = np.where(valid, np.char.add(np.char.add(arrows, rounded.astype(str)), '%'), '')
+    colors = np.select([up, down], [D3_COLORS[2], D3_COLORS[3]], 'gray')
+    return (text, colors)
+
+def get_flows(account_option: str, filter_options: FilterOptions, time_grain: TimeGrain, **kwargs: Any) -> tuple[pd.DataFrame, TimeGrain]:
+    """Gets the flows to plot for the given account option (or 'Savings').
+    If there would be more than MAX_PERIODS time periods, coarsens the time grain until there are few enough (or it is yearly).
+    Returns the flows along with the time grain actually used."""
+    while True:
+        if (account_option == 'Savings'):
+            flows = get_income_expense_data(filter_options, time_grain, **kwargs)
+            num_periods = len(flows)
+        else:
+            flows = get_account_flows(filter_options, account_option, time_grain, **kwargs).reset_index()
+            num_periods = flows['date'].nunique()
+        coarser = time_grain.coarser
+        if (num_periods <= MAX_PERIODS) or (coarser is None):
+            return (flows, time_grain)
+        time_grain = coarser
 
 def make_simple_bars(ledger: Ledger, flows: pd.DataFrame, currency: str, account_option: str) -> go.Figure:
+    # plotly.express is slow to import and only needed here
+    import plotly.express as px
     flows = flows.rename(columns = {'amount': currency})
     pct_change = 100 * flows[currency].pct_change()
-    text, text_color = zip(*[render_percent(pct) for pct in pct_change])
+    text, text_color = render_percents(pct_change.to_numpy())
     flows['pct'] = text
     fig = px.bar(flows, x = 'date', y = currency, text = 'pct', hover_data = {currency: ':,d', 'pct': False})
     color = ledger.account_type_colors[account_option]
-    textfont = {'color': text_color}
+    textfont = {'color': text_color.tolist()}
     fig.update_traces(marker_color = color, textangle = 0, textposition = 'outside', textfont = textfont)
     return fig
 
-def simplify_group(group: pd.DataFrame) -> pd.DataFrame:
-    group_sorted = group.sort_values(by = 'amount', key = abs, ascending = False)
-    head = group_sorted.head(MAX_STACK_SEGMENTS)
-    tail = group_sorted.tail(-MAX_STACK_SEGMENTS)
-    if len(tail) == 0:
-        return head
-    s = pd.Series({'date': tail.iloc[0].date, 'account': 'Other', 'amount': tail.amount.sum()})
-    return pd.concat([head, s.to_frame().T])
+def simplify_flows(flows: pd.DataFrame) -> pd.DataFrame:
+    """For each date, keeps the MAX_STACK_SEGMENTS accounts of largest magnitude, lumping the rest into a single 'Other' row."""
+    flows = flows.assign(_abs = flows['amount'].abs()).sort_values(['date', '_abs'], ascending = [True, False])
+    rank = flows.groupby('date').cumcount()
+    keep = rank < MAX_STACK_SEGMENTS
+    if keep.all():  # no date has too many accounts, so there is nothing to lump together
+        return flows.drop(columns = '_abs').reset_index(drop = True)
+    head = flows[keep].drop(columns = '_abs')
+    tail = flows[~keep].groupby('date', as_index = False)['amount'].sum().assign(account = 'Other')
+    # stable sort keeps each date's rows in rank order, with 'Other' last
+    return pd.concat([head, tail], ignore_index = True, copy = False).sort_values('date', kind = 'stable', ignore_index = True)
 
 def make_stacked_bars(flows: pd.DataFrame, currency: str) -> go.Figure:
-    flows = flows.groupby('date').apply(simplify_group).reset_index(drop = True)
-    colors = D3_COLORS
-    assert len(colors) >= MAX_STACK_SEGMENTS + 1
-    flows['index'] = flows.groupby('date').cumcount()
-    flows['pct'] = flows.groupby('date', group_keys = False)['amount'].apply(lambda x: 100 * x / x.sum())
-    fig = go.Figure()
-    for tup in flows.itertuples():
-        color = colors[tup.index]
-        customdata = [[tup.account, color, tup.pct]]
-        hovertemplate = '<span style="color: %{customdata[1]};">%{customdata[0]}</span><br>%{x}<br>%{y:,d} ' + currency + ' (%{customdata[2]:.2g}%)'
-        marker = {'color': color}
-        fig.add_trace(go.Bar(x = [tup.date], y = [tup.amount], customdata = customdata, hovertemplate = hovertemplate, marker = marker, name = '', showlegend = False))
-    fig.update_layout(barmode = 'stack')
+    flows = simplify_flows(flows)
+    grouped = flows.groupby('date')['amount']
+    amounts = flows['amount'].to_numpy()
+    pcts = 100.0 * amounts / grouped.transform('sum').to_numpy()
+    # stack the segments manually (each bar starts where the previous one in its date ends), so a single trace suffices
+    bases = grouped.cumsum().to_numpy() - amounts
+    colors = np.array(D3_COLORS)[flows.groupby('date').cumcount().to_numpy()]
+    customdata = np.array([flows['account'], colors, pcts], dtype = object).T
+    hovertemplate = '<span style="color: %{customdata[1]};">%{customdata[0]}</span><br>%{x}<br>%{y:,d} ' + currency + ' (%{customdata[2]:.2g}%)'
+    marker = {'color': colors}
+    fig = go.Figure(go.Bar(x = flows['date'].to_numpy(), y = amounts, base = bases, customdata = customdata, hovertemplate = hovertemplate, marker = marker, name = '', showlegend = False))
+    fig.update_layout(barmode = 'overlay')
     return fig
 
 def make_savings_bars(ledger: Ledger, flows: pd.DataFrame, currency: str) -> go.Figure:
     fig = go.Figure()
-    colors = [D3_COLORS[i] for i in [2, 0, 3, 4]]
-    for (col, marker_color) in zip(flows.columns, colors):
+    dates = flows.index.to_numpy()
+    for (col, marker_color) in zip(flows.columns, SAVINGS_COLORS):
         hovertemplate = '%{y:,d} ' + currency
-        bar = go.Bar(x = flows.index, y = flows[col], name = col, hovertemplate = hovertemplate, marker_color = marker_color)
+        bar = go.Bar(x = dates, y = flows[col].to_numpy(), name = col, hovertemplate = hovertemplate, marker_color = marker_color)
         fig.add_trace(bar)
     fig.update_layout(barmode = 'group', bargap = 0.15, bargroupgap = 0.1)
     return fig
@@ -78,7 +106,7 @@ def make_savings_bars(ledger: Ledger, flows: pd.DataFrame, currency: str) -> go.
 def run() -> None:
     st.markdown('<h3 style="text-align: center">Cash flows over time</h3>', unsafe_allow_html=True)
     opts = setup_sidebar()
-    ledger = get_ledger().filter(opts.filter_options)
+    ledger = get_ledger()
     currency = ledger.main_currency
     account_type = st.session_state.get('account_type', ledger.account_types['income'])
     account_options = [ledger.account_types[key] for key in ['income', 'expenses']] + ['Savings']
@@ -87,20 +115,22 @@ def run() -> None:
     i = account_options.index(account_type)
     account_option = sac.buttons(items = account_options, index = i, align = 'center', radius = 'md')
     account_depth = ledger.config.default_account_depth if (stacked and (account_option != 'Savings')) else None
-    flow_kwargs = {'currency': currency, 'time_grain': opts.time_grain, 'account_depth': account_depth, 'adjust_sign': True}
+    flow_kwargs = {'currency': currency, 'account_depth': account_depth, 'adjust_sign': True}
     with chart.container():
+        (flows, time_grain) = get_flows(account_option, opts.filter_options, opts.time_grain, **flow_kwargs)
+        if (time_grain != opts.time_grain):
+            st.caption(f'Too many {opts.time_grain.value} periods to plot; showing {time_grain.value} totals instead.')
         if (account_option == 'Savings'):
             # TODO: implement stacked & grouped?
-            flows = ledger.income_expense_data(**flow_kwargs).rename(columns = {'amount': currency})  # type: ignore
             fig = make_savings_bars(ledger, flows, currency)
+        elif stacked:
+            fig = make_stacked_bars(flows, currency)
         else:
-            flows = ledger.account_flows(account_option, **flow_kwargs).reset_index()  # type: ignore
-            if stacked:
-                fig = make_stacked_bars(flows, currency)
-            else:
-                fig = make_simple_bars(ledger, flows, currency, account_option)
+            fig = make_simple_bars(ledger, flows, currency, account_option)
         showlegend = account_option == 'Savings'
-        fig.update_layout(showlegend = showlegend)
+        # keep zoom/legend state across reruns that redraw the same kind of chart
+        uirevision = f'{account_option}-{stacked}'
+        fig.update_layout(showlegend = showlegend, uirevision = uirevision)
         st.plotly_chart(fig, use_container_width = True)
 
 
@@ -1,31 +1,44 @@
 from dataclasses import dataclass
 from datetime import date, datetime
 import os
-from typing import Optional
+from typing import Any, Optional
 
+import pandas as pd
 import streamlit as st
 
 from garbanzo.ledger import FilterOptions, Ledger, TimeGrain
 
 
+TIME_GRAIN_DICT = TimeGrain.value_dict()
+TIME_GRAIN_NAMES = list(TIME_GRAIN_DICT)
+
+
 def date_to_datetime(date: Optional[date]) -> Optional[datetime]:
     if date is None:
         return None
     return datetime(date.year, date.month, date.day)
 
-@st.cache_data
+@st.cache_resource(show_spinner = False)
 def load_ledger(path: str) -> Ledger:
     return Ledger.load(path)
 
 def get_ledger() -> Ledger:
-    if 'ledger' not in st.session_state:
-        ledger_path = os.getenv('LEDGER_PATH')
-        if ledger_path is None:
-            raise ValueError('environment variable LEDGER_PATH must be set')
-        with st.spinner(f'Loading beancount ledger: {ledger_path}'):
-            ledger = load_ledger(ledger_path)
-        st.session_state['ledger'] = ledger
-    return st.session_state['ledger']
+    ledger_path = os.getenv('LEDGER_PATH')
+    if ledger_path is None:
+        raise ValueError('environment variable LEDGER_PATH must be set')
+    with st.spinner(f'Loading beancount ledger: {ledger_path}'):
+        return load_ledger(ledger_path)
+
+@st.cache_data
+def get_account_flows(filter_options: FilterOptions, account_prefix: str, time_grain: TimeGrain, **kwargs: Any) -> pd.Series:
+    """Computes Ledger.account_flows on the filtered ledger.
+    Results are cached by filter options and arguments, so reruns that only change the plot mode are free."""
+    return get_ledger().filter(filter_options).account_flows(account_prefix, time_grain, **kwargs)
+
+@st.cache_data
+def get_income_expense_data(filter_options: FilterOptions, time_grain: TimeGrain, **kwargs: Any) -> pd.DataFrame:
+    """Computes Ledger.income_expense_data on the filtered ledger, with caching."""
+    return get_ledger().filter(filter_options).income_expense_data(time_grain, **kwargs)
 
 
 @dataclass
@@ -36,20 +49,15 @@ class SidebarOptions:
 
 def setup_sidebar() -> SidebarOptions:
     with st.sidebar:
-        if 'ledger' in st.session_state:
-            default_start_date = st.session_state['ledger'].config.default_start_date
-        else:
-            default_start_date = None
+        default_start_date = get_ledger().config.default_start_date
         min_date = st.date_input('Start date', value = default_start_date, format = 'YYYY-MM-DD')
         max_date = st.date_input('End date', value = None, format = 'YYYY-MM-DD')
         assert (min_date is None) or isinstance(min_date, date)
         assert (max_date is None) or isinstance(max_date, date)
         filter_options = FilterOptions(date_to_datetime(min_date), date_to_datetime(max_date))
-        time_grain_dict = TimeGrain.value_dict()
-        time_grains = list(time_grain_dict)
-        selected = st.selectbox('Time grain', time_grains, index = time_grains.index('monthly'))
+        selected = st.selectbox('Time grain', TIME_GRAIN_NAMES, index = TIME_GRAIN_NAMES.index('monthly'))
         assert isinstance(selected, str)
-        time_grain = time_grain_dict[selected]
+        time_grain = TIME_GRAIN_DICT[selected]
     sidebar_options = SidebarOptions(filter_options, time_grain)
     st.session_state['sidebar_options'] = sidebar_options
     return sidebar_options
@@ -1,13 +1,13 @@
-from collections import defaultdict
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import date, datetime
 from enum import Enum
-from functools import partial
+from functools import cached_property
 from pathlib import Path
 from typing import Any, NamedTuple, Optional, Set, TypeAlias, cast
 
 from beancount import loader
 import beancount.core.data
+import numpy as np
 import pandas as pd
 from plotly.colors import qualitative
 
@@ -25,7 +25,21 @@ def split_account(account: str) -> list[str]:
     return account.split(':')
 
 def account_at_depth(account: str, depth: int) -> str:
-    return ':'.join(split_account(account)[:depth])
+    # no need to split beyond the requested depth
+    return ':'.join(account.split(':', depth)[:depth])
+
+def account_prefixes(account: str) -> list[str]:
+    """Gets the truncations of an account at every depth, from 0 (the empty string) up to the full account."""
+    prefixes = ['']
+    end = -1
+    for part in split_account(account):
+        end += len(part) + 1
+        prefixes.append(account[:end])
+    return prefixes
+
+def dates_to_array(dates: list[date]) -> np.ndarray:
+    """Converts a list of dates to a numpy datetime64[ns] array."""
+    return np.array(dates, dtype = 'datetime64[D]').astype('datetime64[ns]')
 
 
 class Transaction(NamedTuple):
@@ -38,7 +52,7 @@ class Transaction(NamedTuple):
 
     @classmethod
     def from_beancount(cls, txn: beancount.core.data.Transaction) -> 'Transaction':
-        return cls(**{field: getattr(txn, field) for field in cls._fields})
+        return cls(txn.date, txn.payee, txn.narration, txn.tags, txn.links, txn.meta)
 
 
 class Posting(NamedTuple):
@@ -103,6 +117,51 @@ class TimeGrain(str, Enum):
             case _:
                 return 'YS'
 
+    def period_labels(self, dates: np.ndarray) -> np.ndarray:
+        """Given an array of datetime64 dates, returns the label of the time period containing each one.
+        These match the labels pd.Grouper assigns with this time grain's frequency."""
+        days = dates.astype('datetime64[D]')
+        match self:
+            case TimeGrain.DAILY:
+                labels = days
+            case TimeGrain.WEEKLY:
+                # weeks end on (and are labeled by) Sundays; 1970-01-01 was a Thursday
+                weekdays = (days.astype(np.int64) + 3) % 7
+                labels = days + (6 - weekdays)
+            case TimeGrain.MONTHLY:
+                labels = days.astype('datetime64[M]')
+            case TimeGrain.QUARTERLY:
+                months = days.astype('datetime64[M]').astype(np.int64)
+                labels = (months - months % 3).astype('datetime64[M]')
+            case _:
+                labels = days.astype('datetime64[Y]')
+        return labels.astype('datetime64[ns]')
+
+    @property
+    def coarser(self) -> Optional['TimeGrain']:
+        """Gets the next coarser time grain, or None if this is already the coarsest."""
+        grains = list(TimeGrain)
+        i = grains.index(self)
+        return grains[i + 1] if (i + 1 < len(grains)) else None
+
+
+def account_mask(df: pd.DataFrame, account_prefix: str, currency: str) -> np.ndarray:
+    """Given a dataframe with categorical 'account' and 'currency' columns, gets a boolean mask of the rows whose account starts with the given prefix and whose currency matches."""
+    accounts = df['account'].cat
+    # match the prefix against the (few) distinct accounts, then look up each row's account code
+    account_matches = np.asarray(accounts.categories.str.startswith(account_prefix), dtype = bool)
+    return account_matches[accounts.codes.to_numpy()] & (df['currency'] == currency).to_numpy()
+
+def sum_by_period(df: pd.DataFrame, time_grain: TimeGrain) -> pd.Series:
+    """Sums the 'amount' column of a dataframe within each time period of its 'date' column.
+    Equivalent to df.groupby(pd.Grouper(key = 'date', freq = time_grain.frequency))['amount'].sum(), including zeros for empty periods."""
+    labels = time_grain.period_labels(df['date'].to_numpy())
+    if (len(labels) == 0):
+        return pd.Series([], index = pd.DatetimeIndex([], freq = time_grain.frequency, name = 'date'), name = 'amount', dtype = float)
+    index = pd.date_range(labels.min(), labels.max(), freq = time_grain.frequency, name = 'date')
+    totals = np.bincount(index.searchsorted(labels), weights = df['amount'].to_numpy(), minlength = len(index))
+    return pd.Series(totals, index = index, name = 'amount')
+
 
 @dataclass(frozen = True)
 class FilterOptions:
@@ -110,7 +169,13 @@ class FilterOptions:
     max_date: Optional[datetime] = None
 
     def filter_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Filters a dataframe based on the filter options."""
+        """Filters a dataframe based on the filter options.
+        If the dataframe is sorted by date, this selects a contiguous slice via binary search."""
+        dates = df['date']
+        if dates.is_monotonic_increasing:
+            start = 0 if (self.min_date is None) else dates.searchsorted(self.min_date, side = 'left')
+            stop = len(df) if (self.max_date is None) else dates.searchsorted(self.max_date, side = 'right')
+            return df.iloc[start:stop]
         if (self.min_date is not None):
             df = df[df['date'] >= self.min_date]
         if (self.max_date is not None):
@@ -125,19 +190,15 @@ class Ledger:
     transactions: pd.DataFrame
     postings: pd.DataFrame
     prices: pd.DataFrame
+    # caches for account_flows (these are safe since the ledger is immutable)
+    _flow_cache: dict[tuple[Any, ...], pd.Series] = field(default_factory = dict, init = False, compare = False)
+    _totals_cache: dict[TimeGrain, pd.DataFrame] = field(default_factory = dict, init = False, compare = False)
 
     @staticmethod
     def make_config(entries: list[beancount.core.data.Custom]) -> GarbanzoConfig:
-        config_dict = {}
-        income_deduction_accounts = []
-        for entry in entries:
-            if entry.type == 'garbanzo-option':
-                [key, val] = entry.values
-                name = key.value.replace('-', '_')
-                if (name == 'income_deduction_account'):
-                    income_deduction_accounts.append(val.value)
-                else:
-                    config_dict[name] = val.value
+        options = [(key.value.replace('-', '_'), val.value) for entry in entries if (entry.type == 'garbanzo-option') for (key, val) in [entry.values]]
+        income_deduction_accounts = [val for (name, val) in options if (name == 'income_deduction_account')]
+        config_dict = {name: val for (name, val) in options if (name != 'income_deduction_account')}
         config_dict['income_deduction_accounts'] = income_deduction_accounts
         return GarbanzoConfig(**config_dict)
 
@@ -147,22 +208,59 @@ class Ledger:
         # TODO: for now, we do not allow errors, but perhaps we should be more permissive
         if errors:
             raise ValueError(f'{len(errors)} error(s) occurred in beancount ledger')
-        groups = defaultdict(list)
+        # build each table column-by-column (rather than as a list of row tuples), in a single pass over the entries
+        customs, price_entries = [], []
+        txn_dates: list[date] = []
+        payees, narrations, tags, links, txn_metas = [], [], [], [], []
+        txn_ids, accounts, amounts, currencies, costs, cost_currencies, posting_prices, price_currencies, posting_metas = [], [], [], [], [], [], [], [], []
+        (transaction_type, price_type, custom_type) = (beancount.core.data.Transaction, beancount.core.data.Price, beancount.core.data.Custom)
         for entry in entries:
-            groups[type(entry)].append(entry)
-        config = cls.make_config(groups[beancount.core.data.Custom])
-        txn_rows = []
-        posting_rows = []
-        for (txn_id, txn) in enumerate(groups[beancount.core.data.Transaction]):
-            txn_rows.append(Transaction.from_beancount(txn))
-            for posting in txn.postings:
-                posting_rows.append(Posting.from_beancount(txn_id, txn.date, posting))
-        transactions = pd.DataFrame(txn_rows)
-        postings = pd.DataFrame(posting_rows)
-        price_rows = [Price.from_beancount(price) for price in groups[beancount.core.data.Price]]
-        prices = pd.DataFrame(price_rows)
-        for df in [transactions, postings, prices]:
-            df['date'] = pd.to_datetime(df['date'])
+            entry_type = type(entry)
+            if entry_type is transaction_type:
+                txn_id = len(txn_dates)
+                txn_dates.append(entry.date)
+                payees.append(entry.payee)
+                narrations.append(entry.narration)
+                tags.append(entry.tags)
+                links.append(entry.links)
+                txn_metas.append(entry.meta)
+                for posting in entry.postings:
+                    (cost, price) = (posting.cost, posting.price)
+                    txn_ids.append(txn_id)
+                    accounts.append(posting.account)
+                    amounts.append(posting.units.number)
+                    currencies.append(posting.units.currency)
+                    costs.append(None if (cost is None) else cost.number)
+                    cost_currencies.append(None if (cost is None) else cost.currency)
+                    posting_prices.append(None if (price is None) else price.number)
+                    price_currencies.append(None if (price is None) else price.currency)
+                    posting_metas.append(posting.meta)
+            elif entry_type is price_type:
+                price_entries.append(entry)
+            elif entry_type is custom_type:
+                customs.append(entry)
+        config = cls.make_config(customs)
+        txn_dates_arr = dates_to_array(txn_dates)
+        transactions = pd.DataFrame(dict(zip(Transaction._fields, [txn_dates_arr, payees, narrations, tags, links, txn_metas])))
+        # each posting takes the date of its transaction
+        txn_ids_arr = np.array(txn_ids, dtype = np.int64)
+        posting_dates = txn_dates_arr[txn_ids_arr]
+        # numeric columns hold Decimals, which are converted to floats in bulk (missing values become NaN)
+        [amounts_arr, costs_arr, prices_arr] = [np.array(vals, dtype = np.float64) for vals in [amounts, costs, posting_prices]]
+        postings = pd.DataFrame(dict(zip(Posting._fields, [txn_ids_arr, posting_dates, accounts, amounts_arr, currencies, costs_arr, cost_currencies, prices_arr, price_currencies, posting_metas])))
+        prices = pd.DataFrame({
+            'date': dates_to_array([price.date for price in price_entries]),
+            'currency': [price.currency for price in price_entries],
+            'amount': np.array([price.amount.number for price in price_entries], dtype = np.float64),
+            'conv_currency': [price.amount.currency for price in price_entries],
+        })
+        # store low-cardinality string columns as categoricals, so comparisons and groupbys work on integer codes
+        for col in ['account', 'currency', 'cost_currency', 'price_currency']:
+            postings[col] = postings[col].astype('category')
+        for col in ['currency', 'conv_currency']:
+            prices[col] = prices[col].astype('category')
+        # beancount sorts entries by date, but sort postings explicitly so that date filtering can use binary search
+        postings = postings.sort_values(['date', 'account'], kind = 'mergesort', ignore_index = True)
         return cls(config, options, transactions, postings, prices)
 
     @property
@@ -171,56 +269,85 @@ class Ledger:
         operating_currencies = cast(list[str], self.options.get('operating_currency', []))
         return operating_currencies[0] if operating_currencies else 'USD'
 
-    @property
+    @cached_property
     def account_types(self) -> dict[str, str]:
         """Gets a mapping from the canonical category names (lowercase) to their configured names."""
         return {key: cast(str, self.options[f'name_{key}']) for key in ACCOUNT_TYPE_NAMES}
 
-    @property
+    @cached_property
+    def account_type_keys(self) -> dict[str, str]:
+        """Gets a mapping from the configured category names to their canonical names (the inverse of account_types)."""
+        return {name: key for (key, name) in self.account_types.items()}
+
+    @cached_property
     def account_type_colors(self) -> dict[str, str]:
         """For plotting purposes, gets a mapping from canonical category names to plot colors."""
-        return {cast(str, self.options[f'name_{key}']): color for (key, color) in zip(ACCOUNT_TYPE_NAMES, qualitative.D3)}
+        return dict(zip(self.account_types.values(), qualitative.D3))
 
     def filter(self, filter_options: FilterOptions) -> 'Ledger':
         return Ledger(self.config, self.options, filter_options.filter_dataframe(self.transactions), filter_options.filter_dataframe(self.postings), filter_options.filter_dataframe(self.prices))
 
+    @cached_property
+    def account_depth_table(self) -> np.ndarray:
+        """Gets a table whose (i, d) entry is the i-th account category truncated to depth d.
+        The last column holds the full account names."""
+        categories = self.postings['account'].cat.categories
+        rows = [account_prefixes(account) for account in categories]
+        num_cols = max((len(row) for row in rows), default = 1)
+        # pad shallower accounts with their full name
+        return np.array([row + [row[-1]] * (num_cols - len(row)) for row in rows], dtype = object).reshape(len(rows), num_cols)
+
+    def period_totals(self, time_grain: TimeGrain) -> pd.DataFrame:
+        """Gets the total posting amount for each time period, account, and currency, as a table with columns date, account, currency, amount.
+        This is computed once per time grain; account_flows aggregates over it rather than over the individual postings."""
+        if time_grain not in self._totals_cache:
+            postings = self.postings[['date', 'account', 'currency', 'amount']]
+            postings = postings.assign(date = time_grain.period_labels(postings['date'].to_numpy()))
+            self._totals_cache[time_grain] = postings.groupby(['date', 'account', 'currency'], observed = True)['amount'].sum().reset_index()
+        return self._totals_cache[time_grain]
+
     def account_flows(self, account_prefix: str, time_grain: TimeGrain, currency: Optional[str] = None, account_depth: Optional[int] = None, adjust_sign: bool = False) -> pd.Series:
         """Calculates the total cash flow for a given account prefix with a given time grain.
         This is the sum total of transaction amounts within each time period.
         If account_depth is a given integer, additionally groups by the account at the given maximum depth.
         (E.g. if level is 2, would include as a group the prefix 'Expenses:Restaurants' and the like.)
-        If adjust_sign = True, negates the sign of income/liability flows to be positive rather than negative."""
+        If adjust_sign = True, negates the sign of income/liability flows to be positive rather than negative.
+        Results are memoized, so repeated calls with the same arguments are cheap."""
         currency = self.main_currency if (currency is None) else currency
-        grouper = pd.Grouper(key = 'date', freq = time_grain.frequency)
-        flags = self.postings.account.str.startswith(account_prefix) & (self.postings.currency == currency)
-        df = self.postings[flags]
-        if (account_depth is None):
-            flows = df.groupby(grouper)['amount'].sum()
-        else:
-            df.loc[:, 'account'] = df.account.map(partial(account_at_depth, depth = account_depth))
-            grouped = df.groupby(grouper)
-            flows = grouped.apply(lambda x: x.groupby('account')['amount'].sum())
-        if adjust_sign:
-            account_type = account_at_depth(account_prefix, 1)
-            if account_type in [self.account_types[tp] for tp in ['income', 'liabilities']]:
-                flows = -flows
-        return flows
+        key = (account_prefix, time_grain, currency, account_depth, adjust_sign)
+        if key not in self._flow_cache:
+            totals = self.period_totals(time_grain)
+            df = totals[account_mask(totals, account_prefix, currency)]
+            if (account_depth is None):
+                flows = sum_by_period(df, time_grain)
+            else:
+                table = self.account_depth_table
+                depth = min(account_depth, table.shape[1] - 1)
+                df = df.assign(account = table[df['account'].cat.codes.to_numpy(), depth])
+                flows = df.groupby(['date', 'account'])['amount'].sum()
+            if adjust_sign:
+                account_type = self.account_type_keys.get(account_at_depth(account_prefix, 1))
+                if account_type in ['income', 'liabilities']:
+                    # flows is a fresh aggregate, so it is safe to negate in place
+                    flows *= -1
+            self._flow_cache[key] = flows
+        # return a copy so that callers cannot modify the cached result
+        return self._flow_cache[key].copy()
 
     def income_expense_data(self, time_grain: TimeGrain, **kwargs: Any) -> pd.DataFrame:
         kw: dict[str, Any] = {**kwargs, 'adjust_sign': True}
         income_account = self.account_types['income']
         income = self.account_flows(income_account, time_grain, **kw)
         # income['account'] = income_account
-        disposable = income.copy()
-        for account_prefix in self.config.income_deduction_accounts:
-            disposable -= self.account_flows(account_prefix, time_grain, **kw).reindex(income.index).fillna(0.0)
-        income = income.reset_index()
-        income['account'] = income_account
+        disposable = income
+        deductions = [self.account_flows(account_prefix, time_grain, **kw) for account_prefix in self.config.income_deduction_accounts]
+        if deductions:
+            # align all the deductions to the income periods at once
+            disposable = income - pd.concat(deductions, axis = 1).reindex(income.index).fillna(0.0).sum(axis = 1)
         expense_account = self.account_types['expenses']
-        expenses = self.account_flows(expense_account, time_grain, **kw).reset_index()
-        expenses['account'] = expense_account
-        combined = pd.concat([income, expenses]).pivot(index = 'date', columns = 'account').fillna(0.0).droplevel(level = 0, axis = 1)[[income_account, expense_account]]
-        combined['Disposable'] = disposable
+        expenses = self.account_flows(expense_account, time_grain, **kw)
+        # align the series on the union of their dates, rather than pivoting a long-form frame
+        index = income.index.union(expenses.index)
+        combined = pd.DataFrame({income_account: income.reindex(index, fill_value = 0.0), expense_account: expenses.reindex(index, fill_value = 0.0), 'Disposable': disposable.reindex(index)})
         combined['Savings'] = combined[income_account] - combined[expense_account]
-        cols = combined.columns[[0, 2, 1, 3]]
-        return combined[cols]
+        return combined[[income_account, 'Disposable', expense_account, 'Savings']]